@@ -1,3 +1,4 @@
+import copy
 import datetime
 import json
 import logging
@@ -5,6 +6,7 @@ import os.path
 import pathlib
 import random
 import socket
+import struct
 import typing
 import zipfile
 from zipfile import ZipFile
@@ -42,14 +44,103 @@ def make_json_serializable(o: typing.Any):
     _log.error(f"Object {o} is not JSON-serializable.")
     return str(o)
 
+def _parse_records(f: typing.BinaryIO):
+    """
+    Parse a shard in a single pass. Yields (line number, raw line, entry, error)
+    where error is None for valid records. Only the last line may lack its
+    line end; if it does not contain valid JSON, the write has been interrupted.
+    """
+    for line_no, raw in enumerate(f, start=1):
+        if not raw.strip():
+            continue
+        try:
+            yield line_no, raw, json.loads(raw), None
+        except ValueError as e:
+            if raw.endswith(b"\n"):
+                yield line_no, raw, None, f"Invalid JSON ({e})."
+            else:
+                yield line_no, raw, None, "Truncated record (missing line end)."
+
+
+def _split_records(source: str, f: typing.BinaryIO, out: typing.BinaryIO
+                   ) -> typing.Tuple[typing.List[typing.Tuple[str, int, str]],
+                                     typing.List[bytes]]:
+    """
+    Stream the valid records of `f` into `out`. Returns the corrupt records as in
+    `Database.verify` and their raw lines (for the quarantine file).
+    """
+    corrupt = []
+    lines = []
+    for line_no, raw, _, error in _parse_records(f):
+        line = raw if raw.endswith(b"\n") else raw + b"\n"
+        if error is None:
+            out.write(line)
+        else:
+            corrupt.append((source, line_no, error))
+            lines.append(line)
+    return corrupt, lines
+
+
+def _find_corrupt(source: str, f: typing.BinaryIO) -> typing.List[typing.Tuple[str, int, str]]:
+    return [(source, line_no, error) for line_no, _, _, error in _parse_records(f)
+            if error is not None]
+
+
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[i:i + 4])
+        if header_id != 0x0001:
+            fields.append(extra[i:i + 4 + size])
+        i += 4 + size
+    return b"".join(fields)
+
+
+def _copy_zip_member_raw(src_path: str, info: zipfile.ZipInfo, dst: ZipFile):
+    """
+    Copy a member into another archive without decompressing and recompressing
+    it. `zipfile` has no public API for this, so we write the local header
+    ourselves and register the member in the central directory of `dst`.
+    """
+    zinfo = copy.copy(info)
+    zinfo.flag_bits &= ~0x08  # sizes and CRC are known, no data descriptor
+    zinfo.extra = _strip_zip64_extra(info.extra)  # re-added by `FileHeader`
+    with open(src_path, "rb") as src:
+        src.seek(info.header_offset)
+        header = src.read(30)
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        src.seek(info.header_offset + 30 + name_len + extra_len)
+        zinfo.header_offset = dst.fp.tell()
+        dst.fp.write(zinfo.FileHeader())
+        remaining = info.compress_size
+        while remaining > 0:
+            block = src.read(min(remaining, 1 << 20))
+            if not block:
+                raise RuntimeError(f"Unexpected end of archive '{src_path}'.")
+            dst.fp.write(block)
+            remaining -= len(block)
+    dst.filelist.append(zinfo)
+    dst.NameToInfo[zinfo.filename] = zinfo
+    dst.start_dir = dst.fp.tell()
+
 class Database:
     """
     A simple database to dump data (dictionaries) into. Should be reasonably threadsafe
     even for slurm pools with NFS.
     """
 
-    def __init__(self, path: typing.Union[str, pathlib.Path]):
+    def __init__(self, path: typing.Union[str, pathlib.Path], fsync: bool = False):
+        """
+        :param path: Folder of the database.
+        :param fsync: Force every flush to disk. This is slow, especially on NFS,
+            and not necessary to detect torn records.
+        """
         self.path = path
+        self._fsync = fsync
+        # Whether our shard is known to end with a newline. Only unknown before
+        # the first write or after a partial write could not be rolled back.
+        self._tail_clean = False
         if not os.path.exists(path):
             # Could fail in very few unlucky cases on an NFS (parallel creations)
             os.makedirs(path, exist_ok=True)
@@ -110,41 +201,164 @@ class Database:
         if not self._cache:
             return
         path = os.path.join(self.path, self._subfile_path)
-        with open(path, "a") as f:
-            for data in self._cache:
-                data = make_json_serializable(data)
-                f.write(json.dumps(data) + "\n")
-            _log.info(f"Wrote {len(self._cache)} entries to disk.")
+        # Every record is terminated by a newline, such that a torn write can
+        # only affect the last line. The batch is written at once and rolled
+        # back on failure, such that a retry does not duplicate records.
+        chunk = "".join(json.dumps(make_json_serializable(data)) + "\n"
+                        for data in self._cache).encode()
+        offset = None
+        try:
+            with open(path, "ab+") as f:
+                offset = f.tell()
+                if not self._tail_clean and offset > 0:
+                    f.seek(offset - 1)
+                    if f.read(1) != b"\n":
+                        chunk = b"\n" + chunk  # close off a torn record
+                f.write(chunk)
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except OSError:
+            if offset is not None:
+                try:
+                    os.truncate(path, offset)
+                except OSError:
+                    self._tail_clean = False
+                    _log.error(f"Could not roll back partial write to '{path}'.")
+            raise
+        self._tail_clean = True
+        _log.info(f"Wrote {len(self._cache)} entries to disk.")
         if os.path.getsize(path) <= 0:
             raise RuntimeError("Could not write to disk. Resulting file has zero size.")
         if not os.path.isfile(path):
             raise RuntimeError("Could not write to disk for unknown reasons.")
         self._cache.clear()
 
-    def load(self) -> typing.List[typing.Dict]:
-        data = list(self._cache)
-        # load compressed data
-        compr_path = os.path.join(self.path, "_compressed.zip")
-        if os.path.exists(compr_path):
-            with ZipFile(compr_path, "r") as z:
-                for filename in z.filelist:
-                    with z.open(filename, "r") as f:
-                        for line in f.readlines():
-                            data.append(json.loads(line))
-        # load uncompressed data
-        for fp in os.listdir(self.path):
+    def _data_files(self) -> typing.List[str]:
+        files = []
+        for fp in sorted(os.listdir(self.path)):
             path = os.path.join(self.path, fp)
             if not os.path.isfile(path) or not path.endswith(".data"):
                 continue
-            with open(path, "r") as f:
-                for entry in f.readlines():
-                    data.append(json.loads(entry))
+            files.append(path)
+        return files
+
+    def _iter_sources(self):
+        """
+        Yields (source name, binary file object) for every shard, including the
+        members of the compressed archive.
+        """
+        compr_path = os.path.join(self.path, "_compressed.zip")
+        if os.path.exists(compr_path):
+            with ZipFile(compr_path, "r") as z:
+                for info in z.infolist():
+                    with z.open(info, "r") as f:
+                        yield f"{compr_path}:{info.filename}", f
+        for path in self._data_files():
+            with open(path, "rb") as f:
+                yield path, f
+
+    def load(self) -> typing.List[typing.Dict]:
+        """
+        Load all entries. Corrupt records (e.g., a torn line at the end of a
+        shard of a killed job) are skipped with a warning. Use `verify` to list
+        them and `repair` to remove them from disk.
+        """
+        data = list(self._cache)
+        for source, f in self._iter_sources():
+            for line_no, raw, entry, error in _parse_records(f):
+                if error is None:
+                    data.append(entry)
+                else:
+                    _log.warning(f"Skipping corrupt record in '{source}' "
+                                 f"(line {line_no}): {error}")
         return data
 
+    def verify(self) -> typing.List[typing.Tuple[str, int, str]]:
+        """
+        Stream through all shards and return the corrupt records as tuples of
+        (source, line number, reason). An empty list means the database is intact.
+        """
+        corrupt = []
+        for source, f in self._iter_sources():
+            for line_no, raw, entry, error in _parse_records(f):
+                if error is not None:
+                    corrupt.append((source, line_no, error))
+        return corrupt
+
+    def repair(self) -> typing.List[typing.Tuple[str, int, str]]:
+        """
+        Remove corrupt records from disk and return them as in `verify`.
+        The removed lines are moved into '.corrupt' files next to the shards,
+        which are not read by `load` but removed by `clear`. Only shards with
+        corrupt records are rewritten.
+
+        Warning: Like `compress`, this is not threadsafe! Only run it while
+        no other process is writing to the database.
+        """
+        corrupt = []
+        for path in self._data_files():
+            with open(path, "rb") as f:
+                if not _find_corrupt(path, f):
+                    continue
+            tmp_path = path + ".tmp"
+            with open(path, "rb") as f, open(tmp_path, "wb") as out:
+                bad, lines = _split_records(path, f, out)
+            os.replace(tmp_path, path)
+            # Written after the replace, such that rerunning an interrupted
+            # repair does not quarantine the same lines twice.
+            self._quarantine(path, lines)
+            _log.warning(f"Removed {len(bad)} corrupt records from '{path}'.")
+            corrupt += bad
+        corrupt += self._repair_compressed()
+        return corrupt
+
+    def _quarantine(self, shard: str, lines: typing.List[bytes]):
+        name = os.path.basename(shard)
+        if name.endswith(".data"):
+            name = name[:-len(".data")]
+        with open(os.path.join(self.path, name + ".corrupt"), "ab") as f:
+            f.writelines(lines)
+
+    def _repair_compressed(self) -> typing.List[typing.Tuple[str, int, str]]:
+        compr_path = os.path.join(self.path, "_compressed.zip")
+        if not os.path.exists(compr_path):
+            return []
+        with ZipFile(compr_path, "r") as z:
+            corrupt_members = set()
+            for info in z.infolist():
+                with z.open(info, "r") as f:
+                    if _find_corrupt(info.filename, f):
+                        corrupt_members.add(info.filename)
+        if not corrupt_members:
+            return []
+        # Zip archives do not allow to modify members, so we rebuild the archive.
+        # Only the corrupt members are recompressed, the others are copied as is.
+        corrupt = []
+        quarantine = {}
+        tmp_path = compr_path + ".tmp"
+        with ZipFile(compr_path, "r") as z, ZipFile(tmp_path, "w") as out:
+            for info in z.infolist():
+                if info.filename not in corrupt_members:
+                    _copy_zip_member_raw(compr_path, info, out)
+                    continue
+                with z.open(info, "r") as f, \
+                        out.open(copy.copy(info), "w", force_zip64=True) as member:
+                    bad, lines = _split_records(f"{compr_path}:{info.filename}",
+                                                f, member)
+                corrupt += bad
+                quarantine[info.filename] = lines
+        os.replace(tmp_path, compr_path)
+        for filename, lines in quarantine.items():
+            self._quarantine(filename, lines)
+        _log.warning(f"Removed {len(corrupt)} corrupt records from '{compr_path}'.")
+        return corrupt
+
     def clear(self):
         """
-        Clear database (cache and disk). Note that remaining data in the
-        cache of other nodes may still be written.
+        Clear database (cache and disk), including the '.corrupt' files of
+        `repair`. Note that remaining data in the cache of other nodes may
+        still be written.
         """
         # cache
         self._cache.clear()
@@ -152,10 +366,10 @@ class Database:
         compr_path = os.path.join(self.path, "_compressed.zip")
         if os.path.exists(compr_path):
             os.remove(compr_path)
-        # remaining .data files
+        # remaining .data files, quarantined records, and leftovers of `repair`
         for fp in os.listdir(self.path):
             path = os.path.join(self.path, fp)
-            if not os.path.isfile(path) or not str(path).endswith(".data"):
+            if not os.path.isfile(path) or not str(path).endswith((".data", ".corrupt", ".tmp")):
                 continue
             os.remove(path)
 
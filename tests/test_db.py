@@ -1,6 +1,8 @@
 import os
 import shutil
 import unittest
+import zipfile
+from unittest import mock
 
 from aemeasure import Database
 
@@ -88,3 +90,121 @@ class TestDb(unittest.TestCase):
         db.flush()
         self.assertEqual(len(db.load()), 3)
 
+    def test_torn_record(self):
+        entry = {"entry": "test"}
+        path = "./test_torn"
+        db = self._prepare_db(path)
+        db.dump([dict(entry), dict(entry)])
+        data_path = os.path.join(path, db._subfile_path)
+        with open(data_path, "a") as f:
+            f.write('{"entry": "te')  # simulate a job killed while writing
+        self.assertListEqual(db.load(), [entry, entry])
+        corrupt = db.verify()
+        self.assertEqual(len(corrupt), 1)
+        self.assertEqual(corrupt[0][1], 3)
+        self.assertEqual(len(db.repair()), 1)
+        self.assertListEqual(db.verify(), [])
+        self.assertListEqual(db.load(), [entry, entry])
+        with open(data_path[:-len(".data")] + ".corrupt") as f:
+            self.assertEqual(f.read(), '{"entry": "te\n')
+        self._clear_db(path)
+
+    def test_repair_compressed(self):
+        entry = {"entry": "test"}
+        path = "./test_torn2"
+        db = self._prepare_db(path)
+        db.add(dict(entry))
+        data_path = os.path.join(path, db._subfile_path)
+        with open(data_path, "a") as f:
+            f.write("{invalid}\n")
+        with open(os.path.join(path, "clean.data"), "w") as f:
+            f.write('{"entry": "clean"}\n')
+        db.compress()
+        self.assertEqual(len(db.verify()), 1)
+        self.assertEqual(len(db.repair()), 1)
+        self.assertListEqual(db.verify(), [])
+        self.assertCountEqual(db.load(), [entry, {"entry": "clean"}])
+        with zipfile.ZipFile(os.path.join(path, "_compressed.zip")) as z:
+            for info in z.infolist():
+                self.assertEqual(info.compress_type, zipfile.ZIP_LZMA)
+            self.assertIsNone(z.testzip())
+        with open(data_path[:-len(".data")] + ".corrupt") as f:
+            self.assertEqual(f.read(), "{invalid}\n")
+        self._clear_db(path)
+
+    def test_last_line_without_newline(self):
+        path = "./test_torn3"
+        db = self._prepare_db(path)
+        data_path = os.path.join(path, "manual.data")
+        with open(data_path, "w") as f:
+            f.write('{"a": 1}\n{"a": 2}')  # e.g., edited by hand
+        self.assertListEqual(db.load(), [{"a": 1}, {"a": 2}])
+        self.assertListEqual(db.verify(), [])
+        self.assertListEqual(db.repair(), [])
+        self.assertListEqual(db.load(), [{"a": 1}, {"a": 2}])
+        self.assertFalse(os.path.exists(os.path.join(path, "manual.corrupt")))
+        self._clear_db(path)
+
+    def test_append_after_torn_record(self):
+        path = "./test_torn4"
+        db = self._prepare_db(path)
+        with open(os.path.join(path, db._subfile_path), "w") as f:
+            f.write('{"x": 1}\n{"x": ')  # shard existed before the first flush
+        db.add({"x": 2})
+        self.assertListEqual(db.load(), [{"x": 1}, {"x": 2}])
+        self.assertEqual(len(db.verify()), 1)
+        self._clear_db(path)
+
+    def test_failed_write(self):
+        path = "./test_torn6"
+        db = self._prepare_db(path)
+        db.add({"x": 1})
+        real_open = open
+
+        class TornFile:
+            def __init__(self, f):
+                self._f = f
+
+            def __getattr__(self, name):
+                return getattr(self._f, name)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self._f.close()
+
+            def write(self, data):
+                self._f.write(data[:len(data) // 2])
+                self._f.flush()
+                raise OSError("No space left on device")
+
+        def torn_open(file, mode="r", *args, **kwargs):
+            return TornFile(real_open(file, mode, *args, **kwargs))
+
+        db.dump([{"x": 2}, {"x": 3}], flush=False)
+        # the partial write is rolled back, the retry does not duplicate records
+        with mock.patch("builtins.open", torn_open):
+            self.assertRaises(OSError, db.flush)
+        db.flush()
+        self.assertListEqual(db.load(), [{"x": 1}, {"x": 2}, {"x": 3}])
+        # if the rollback fails, the torn record is closed off before appending
+        db.add({"x": 4}, flush=False)
+        with mock.patch("builtins.open", torn_open), \
+                mock.patch("os.truncate", side_effect=OSError):
+            self.assertRaises(OSError, db.flush)
+        db.flush()
+        self.assertListEqual(db.load(), [{"x": 1}, {"x": 2}, {"x": 3}, {"x": 4}])
+        self.assertEqual(len(db.verify()), 1)
+        self._clear_db(path)
+
+    def test_clear_removes_quarantine(self):
+        path = "./test_torn5"
+        db = self._prepare_db(path)
+        db.add({"x": 1})
+        with open(os.path.join(path, db._subfile_path), "a") as f:
+            f.write('{"x": ')
+        db.repair()
+        db.clear()
+        self.assertListEqual(os.listdir(path), [])
+        self._clear_db(path)